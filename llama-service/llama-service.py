@@ -1,45 +1,156 @@
 import threading
+import queue
 import time
 import torch
 import json
+import re
 import logging
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from transformers import AutoModelForCausalLM, AutoTokenizer, Trainer, TrainingArguments, DataCollatorForLanguageModeling, pipeline
-from datasets import Dataset
-from redis_client import RedisClient
+from transformers import AutoModelForCausalLM, AutoTokenizer, Trainer, TrainerCallback, TrainingArguments, DataCollatorForLanguageModeling, TorchAoConfig, CompileConfig, StaticCache
+from peft import LoraConfig
+from torchao.quantization import Int4WeightOnlyConfig
+from datasets import Dataset, Features, Value
+from redis_client import RedisClient, chunked, same_url, url_index_key, method_index_key
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of keys fetched from Redis per pipelined round trip
+SCAN_BATCH_SIZE = 500
+# Number of URLs classified per guard model generate() call
+GUARD_BATCH_SIZE = 16
+# Guard inputs are padded (or truncated) to this many tokens so the compiled forward sees one shape
+GUARD_MAX_LENGTH = 128
+# Scan chunks buffered between the Redis reader, the model loop and the Redis writer
+PIPELINE_QUEUE_SIZE = 4
+# Keys analyzed more recently than this (in seconds) are skipped
+REANALYZE_AFTER = 600
+# Changed keys reported by keyspace notifications are coalesced for this many seconds
+ANALYZE_DEBOUNCE = 30
+# Full sweeps still run at this interval so age-based rules see keys that never change
+FULL_SWEEP_INTERVAL = 600
+# Token capacity (prompt + generated) of the analysis model's pre-allocated KV cache
+ANALYSIS_CACHE_LENGTH = 1024
+
+# Patterns for extracting decisions from model output
+_ACTION_RE = re.compile(r'\b(delete|refresh|keep)\b')
+_NUM_RE = re.compile(r'\d+')
+
+# Placeholder used to split a rendered chat template around the user message
+_PROMPT_SLOT = "<<request_data>>"
+
+# Typical request used to compile generation paths at startup
+_WARMUP_REQUEST = {
+    "request_method": "GET",
+    "request_url": "/get?warmup=1",
+    "request_headers": '{"Accept": "application/json", "User-Agent": "warmup"}',
+    "response": "{}",
+    "request_count": "1",
+    "last_used": "0",
+}
+
+# Base model shared by the trainer and analyzer threads, loaded once per model id
+_base_models = {}
+_base_models_lock = threading.Lock()
+# Serializes use of a shared base model between training steps and analyzer inference
+_model_lock = threading.Lock()
+
+def load_base_model(model_id):
+    """Return the shared model for model_id, loading it on first use"""
+    with _base_models_lock:
+        if model_id not in _base_models:
+            _base_models[model_id] = AutoModelForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=torch.bfloat16,
+                device_map='auto',
+                attn_implementation='sdpa'
+            )
+        return _base_models[model_id]
+
+@contextmanager
+def base_model_inference(model):
+    """Run inference on the shared model in eval mode with any LoRA adapters switched off"""
+    with _model_lock:
+        was_training = model.training
+        has_adapters = getattr(model, "_hf_peft_config_loaded", False)
+        model.eval()
+        if has_adapters:
+            model.disable_adapters()
+        try:
+            yield
+        finally:
+            if has_adapters:
+                model.enable_adapters()
+            model.train(was_training)
+
+class SharedModelCallback(TrainerCallback):
+    """Hold the shared model lock during training setup and each training step so analyzer inference runs between them"""
+    def __init__(self):
+        self.holding = False
+
+    def acquire(self):
+        _model_lock.acquire()
+        self.holding = True
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # Setup (gradient checkpointing hooks, optimizer param groups) is done; let the analyzer in
+        self.release()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.acquire()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.release()
+
+    def release(self):
+        if self.holding:
+            self.holding = False
+            _model_lock.release()
+
+def iter_training_rows(redis_host, redis_port, redis_db):
+    """Yield one training example per cached request; takes only primitives so datasets can hash it cheaply"""
+    redis_client = RedisClient(host=redis_host, port=redis_port, db=redis_db)
+    for keys in chunked(redis_client.scan_keys(), SCAN_BATCH_SIZE):
+        for request_data in redis_client.hgetall_many(keys):
+            if 'request_url' in request_data and 'response' in request_data:
+                yield {"text": f"Request URL: {request_data['request_url']}\nResponse: {request_data['response']}"}
+
 class LlamaTrainer:
     def __init__(self, model_id='meta-llama/Llama-3.2-1B-Instruct', redis_host='localhost', redis_port=6379, redis_db=0):
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            torch_dtype=torch.bfloat16,
-            device_map='auto'
-        )
+        self.model = load_base_model(model_id)
+        # Fast tokenizers are not safe to use from two threads at once, so each side keeps its own
         self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Only LoRA adapters are trained, so the frozen base weights stay shared with LlamaModel
+        with _model_lock:
+            if not getattr(self.model, "_hf_peft_config_loaded", False):
+                self.model.add_adapter(LoraConfig(r=8, target_modules=['q_proj', 'v_proj'], task_type="CAUSAL_LM"))
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.redis_db = redis_db
         self.redis = RedisClient(host=redis_host, port=redis_port, db=redis_db)
         logger.info("LlamaTrainer initialized successfully")
 
-    def get_training_data(self):
-        keys = self.redis.get_all_keys()
-        data = []
-
-        for key in keys:
-            request_data = self.redis.get_request_data(key)
-            if 'request_url' in request_data and 'response' in request_data:
-                input_text = f"Request URL: {request_data['request_url']}\nResponse: {request_data['response']}"
-                data.append(input_text)
-
-        return data
+    def load_dataset(self, cache_dir):
+        # Rows are streamed into the Arrow table, so only one scan chunk is held in Python at a time
+        return Dataset.from_generator(
+            iter_training_rows,
+            features=Features({"text": Value("string")}),
+            gen_kwargs={"redis_host": self.redis_host, "redis_port": self.redis_port, "redis_db": self.redis_db},
+            cache_dir=cache_dir
+        )
 
-    def prepare_dataset(self, data):
-        dataset = Dataset.from_dict({"text": data})
+    def prepare_dataset(self, dataset):
+        # Close over the tokenizer only, so datasets doesn't hash the trainer (and its model) to fingerprint map()
+        tokenizer = self.tokenizer
 
         def tokenize_function(examples):
-            return self.tokenizer(examples["text"], padding="max_length", truncation=True, max_length=512)
+            # Padding is left to the data collator, per batch
+            return tokenizer(examples["text"], truncation=True, max_length=512)
 
         tokenized_dataset = dataset.map(tokenize_function, batched=True)
         return tokenized_dataset
@@ -49,155 +160,235 @@ class LlamaTrainer:
             output_dir="./llama_finetuned",
             overwrite_output_dir=True,
             num_train_epochs=3,
-            per_device_train_batch_size=4,
+            per_device_train_batch_size=16,
+            gradient_accumulation_steps=1,
             save_steps=10_000,
             save_total_limit=2,
-            fp16=True,
+            group_by_length=True,
+            # The model is loaded in bf16, so train in bf16 rather than autocasting to fp16
+            bf16=True,
+            fp16=False,
+            gradient_checkpointing=True,
+            gradient_checkpointing_kwargs={'use_reentrant': False},
+            optim='adamw_torch_fused',
+            dataloader_num_workers=4,
+            torch_compile=False,
             logging_dir='./logs',
         )
 
         data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer, mlm=False
+            tokenizer=self.tokenizer, mlm=False, pad_to_multiple_of=8
         )
 
+        shared_model_callback = SharedModelCallback()
         trainer = Trainer(
             model=self.model,
             args=training_args,
             train_dataset=tokenized_dataset,
             data_collator=data_collator,
+            callbacks=[shared_model_callback],
         )
 
-        trainer.train()
+        # train() enables gradient checkpointing and builds the optimizer from requires_grad before
+        # on_train_begin; disable_adapters() in the analyzer clears requires_grad on the LoRA weights,
+        # so that setup must not overlap with inference
+        shared_model_callback.acquire()
+        try:
+            trainer.train()
+        finally:
+            # Don't leave the analyzer locked out if a step fails
+            shared_model_callback.release()
 
     def run_training(self):
-        logger.info("Fetching data from Redis...")
-        data = self.get_training_data()
-        if not data:
-            logger.info("No data to train on.")
-            return
+        # The Arrow files only live for this run, so each run doesn't leave a copy of the cache behind
+        with tempfile.TemporaryDirectory(prefix="llama_dataset_") as cache_dir:
+            logger.info("Fetching data from Redis...")
+            dataset = self.load_dataset(cache_dir)
+            if dataset.num_rows == 0:
+                logger.info("No data to train on.")
+                return
 
-        logger.info("Preparing dataset...")
-        tokenized_dataset = self.prepare_dataset(data)
+            logger.info("Preparing dataset...")
+            tokenized_dataset = self.prepare_dataset(dataset)
 
-        logger.info("Starting fine-tuning of LLaMA model...")
-        self.fine_tune_model(tokenized_dataset)
-        logger.info("Fine-tuning completed.")
+            logger.info("Starting fine-tuning of LLaMA model...")
+            self.fine_tune_model(tokenized_dataset)
+            logger.info("Fine-tuning completed.")
 
     def update_cache(self, request_data):
         self.redis.store_request_data(request_data)
 
 class LlamaModel:
     def __init__(self, model_id='meta-llama/Llama-3.2-1B-Instruct', guard_model_id="meta-llama/Llama-Guard-3-1B"):
-        self.pipe = pipeline(
-            'text-generation',
-            model=model_id,
-            torch_dtype=torch.bfloat16,
-            device_map='auto'
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.model = load_base_model(model_id)
+        # One pre-sized static KV cache is reused by every call, so generate() compiles its decoding step once.
+        # The forward itself is not replaced with a compiled one because LlamaTrainer trains the same module.
+        self.model.generation_config.compile_config = CompileConfig(mode="reduce-overhead", fullgraph=False)
+        self.kv_cache = StaticCache(
+            config=self.model.config,
+            max_batch_size=1,
+            max_cache_len=ANALYSIS_CACHE_LENGTH,
+            device=self.model.device,
+            dtype=self.model.dtype
         )
+        self._analyze_sys_msg = {
+            "role": "system",
+            "content": (
+                "You are an intelligent cache management assistant. "
+                "Analyze the following request data and determine the optimal caching strategy: "
+                "1. 'delete' - if the content is outdated or irrelevant "
+                "2. 'refresh' - if the content should be refreshed soon "
+                "3. 'keep' - if the content is still valid and useful "
+                "Consider factors like request frequency, content type, and response size."
+            )
+        }
+        self._ttl_sys_msg = {
+            "role": "system",
+            "content": (
+                "You are a cache optimization expert. "
+                "Predict the optimal Time-to-Live (TTL) in seconds for this request. "
+                "Consider factors like content volatility, request frequency, and response size. "
+                "Return only a number between 60 and 86400 (1 minute to 24 hours)."
+            )
+        }
+        self._analyze_prompt = self.build_prompt_template(self._analyze_sys_msg)
+        self._ttl_prompt = self.build_prompt_template(self._ttl_sys_msg)
         self.guard_tokenizer = AutoTokenizer.from_pretrained(guard_model_id)
+        # Left padding keeps generated tokens aligned at the end of each batched row
+        self.guard_tokenizer.padding_side = 'left'
+        if self.guard_tokenizer.pad_token is None:
+            self.guard_tokenizer.pad_token = self.guard_tokenizer.eos_token
+        # The guard model is inference-only, so int4 weight-only quantization halves its VRAM and speeds up decode
+        quantization_config = TorchAoConfig(Int4WeightOnlyConfig(group_size=128))
         self.guard_model = AutoModelForCausalLM.from_pretrained(
             guard_model_id,
             torch_dtype=torch.bfloat16,
-            device_map="auto"
+            device_map="auto",
+            attn_implementation='sdpa',
+            quantization_config=quantization_config
         )
+        self.guard_model.generation_config.cache_implementation = "static"
+        self.guard_model.forward = torch.compile(self.guard_model.forward, mode="reduce-overhead", fullgraph=False)
+        self.warmup()
         logger.info("LlamaModel initialized successfully")
 
-    def check_inappropriate_content(self, user_input):
-        input_text = f"<|user|> {user_input} "
-        input_ids = self.guard_tokenizer.encode(input_text, return_tensors='pt').to(self.guard_model.device)
+    def warmup(self, steps=3):
+        """Run a few representative generations so compilation happens before real traffic"""
+        for _ in range(steps):
+            self.analyze_request(_WARMUP_REQUEST)
+            self.predict_optimal_ttl(_WARMUP_REQUEST)
+            self.check_inappropriate_content_batch([_WARMUP_REQUEST['request_url']])
+
+    def encode(self, text):
+        """Tokenize text that already carries its chat-template special tokens"""
+        return self.tokenizer(text, add_special_tokens=False, return_tensors='pt').input_ids.to(self.model.device)
+
+    def build_prompt_template(self, system_message):
+        """Render the chat template once and pre-tokenize the parts around the user message"""
+        prompt = self.tokenizer.apply_chat_template(
+            [system_message, {"role": "user", "content": _PROMPT_SLOT}],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        prefix, suffix = prompt.split(_PROMPT_SLOT)
+        return self.encode(prefix), self.encode(suffix)
+
+    def generate(self, prompt_template, user_content, max_new_tokens):
+        """Greedy-decode a reply to user_content under a pre-tokenized prompt and return only the new text"""
+        prefix_ids, suffix_ids = prompt_template
+        # Trim the request data rather than overflow the pre-allocated cache
+        budget = ANALYSIS_CACHE_LENGTH - prefix_ids.size(1) - suffix_ids.size(1) - max_new_tokens
+        user_ids = self.encode(user_content)[:, :budget]
+        input_ids = torch.cat([prefix_ids, user_ids, suffix_ids], dim=1)
+
+        with torch.no_grad(), base_model_inference(self.model):
+            self.kv_cache.reset()
+            output_ids = self.model.generate(
+                input_ids,
+                past_key_values=self.kv_cache,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.eos_token_id
+            )
+
+        return self.tokenizer.decode(output_ids[0, input_ids.size(1):], skip_special_tokens=True)
+
+    def check_inappropriate_content_batch(self, user_inputs):
+        """Classify a batch of inputs with a single guard generate() call; True means allowed"""
+        input_texts = [f"<|user|> {user_input} " for user_input in user_inputs]
+        # Fill short slices up to a full batch so every call has the same shape
+        input_texts += [input_texts[-1]] * (GUARD_BATCH_SIZE - len(input_texts))
+        inputs = self.guard_tokenizer(
+            input_texts,
+            return_tensors='pt',
+            padding='max_length',
+            truncation=True,
+            max_length=GUARD_MAX_LENGTH
+        ).to(self.guard_model.device)
 
         with torch.no_grad():
             output_ids = self.guard_model.generate(
-                input_ids,
-                max_length=input_ids.size(1) + 50,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True,
-                pad_token_id=self.guard_tokenizer.eos_token_id
+                **inputs,
+                # The verdict heuristic only looks at the first few words
+                max_new_tokens=8,
+                do_sample=False,
+                num_beams=1,
+                pad_token_id=self.guard_tokenizer.pad_token_id
             )
 
-        output_text = self.guard_tokenizer.decode(output_ids[0], skip_special_tokens=True)
-        response = output_text[len(input_text):].strip()
+        responses = self.guard_tokenizer.batch_decode(
+            output_ids[:, inputs['input_ids'].size(1):],
+            skip_special_tokens=True
+        )
 
-        if "no" in response.lower() or "not allowed" in response.lower():
-            logger.warning("Inappropriate request detected.")
-            return False
+        results = []
+        for response in responses[:len(user_inputs)]:
+            response = response.strip().lower()
+            if "no" in response or "not allowed" in response:
+                logger.warning("Inappropriate request detected.")
+                results.append(False)
+            else:
+                results.append(True)
 
-        return True
+        return results
 
     def analyze_request(self, request_data):
-        conversation = [
-            {
-                "role": "system",
-                "content": (
-                    "You are an intelligent cache management assistant. "
-                    "Analyze the following request data and determine the optimal caching strategy: "
-                    "1. 'delete' - if the content is outdated or irrelevant "
-                    "2. 'refresh' - if the content should be refreshed soon "
-                    "3. 'keep' - if the content is still valid and useful "
-                    "Consider factors like request frequency, content type, and response size."
-                )
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"Request Method: {request_data['request_method']}\n"
-                    f"Request URL: {request_data['request_url']}\n"
-                    f"Request Headers: {request_data['request_headers']}\n"
-                    f"Response Size: {len(request_data.get('response', ''))} bytes\n"
-                    f"Request Count: {request_data.get('request_count', 0)}\n"
-                    f"Last Used: {request_data.get('last_used', 'unknown')}"
-                )
-            }
-        ]
+        user_content = (
+            f"Request Method: {request_data['request_method']}\n"
+            f"Request URL: {request_data['request_url']}\n"
+            f"Request Headers: {request_data['request_headers']}\n"
+            f"Response Size: {len(request_data.get('response', ''))} bytes\n"
+            f"Request Count: {request_data.get('request_count', 0)}\n"
+            f"Last Used: {request_data.get('last_used', 'unknown')}"
+        )
 
         try:
-            output = self.pipe(conversation, max_new_tokens=150)
-            analysis_result = output[0]['generated_text'].strip().lower()
+            analysis_result = self.generate(self._analyze_prompt, user_content, max_new_tokens=150).strip().lower()
             logger.info(f"AI Analysis result: {analysis_result}")
         except Exception as e:
             logger.error(f"Error during model inference: {e}")
             return 'keep'
 
-        if 'delete' in analysis_result:
-            return 'delete'
-        elif 'refresh' in analysis_result:
-            return 'refresh'
-        else:
-            return 'keep'
+        match = _ACTION_RE.search(analysis_result)
+        return match.group(1) if match else 'keep'
 
     def predict_optimal_ttl(self, request_data):
         """Predict optimal TTL based on request patterns and content analysis"""
-        conversation = [
-            {
-                "role": "system",
-                "content": (
-                    "You are a cache optimization expert. "
-                    "Predict the optimal Time-to-Live (TTL) in seconds for this request. "
-                    "Consider factors like content volatility, request frequency, and response size. "
-                    "Return only a number between 60 and 86400 (1 minute to 24 hours)."
-                )
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"URL: {request_data['request_url']}\n"
-                    f"Method: {request_data['request_method']}\n"
-                    f"Response Size: {len(request_data.get('response', ''))} bytes\n"
-                    f"Request Count: {request_data.get('request_count', 0)}\n"
-                    f"Content Type: {request_data.get('content_type', 'unknown')}"
-                )
-            }
-        ]
+        user_content = (
+            f"URL: {request_data['request_url']}\n"
+            f"Method: {request_data['request_method']}\n"
+            f"Response Size: {len(request_data.get('response', ''))} bytes\n"
+            f"Request Count: {request_data.get('request_count', 0)}\n"
+            f"Content Type: {request_data.get('content_type', 'unknown')}"
+        )
 
         try:
-            output = self.pipe(conversation, max_new_tokens=50)
-            result = output[0]['generated_text'].strip()
+            result = self.generate(self._ttl_prompt, user_content, max_new_tokens=50).strip()
             # Extract number from result
-            import re
-            numbers = re.findall(r'\d+', result)
-            if numbers:
-                ttl = int(numbers[0])
+            match = _NUM_RE.search(result)
+            if match:
+                ttl = int(match.group())
                 return max(60, min(86400, ttl))  # Clamp between 60 and 86400
         except Exception as e:
             logger.error(f"Error predicting TTL: {e}")
@@ -207,116 +398,267 @@ class LlamaModel:
 class RequestAnalyzer:
     def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0):
         self.redis = RedisClient(host=redis_host, port=redis_port, db=redis_db)
+        self.redis_db = redis_db
         self.llama = LlamaModel()
-        self.analytics = AnalyticsTracker(redis_host, redis_port, redis_db)
+        self.analytics = AnalyticsTracker(redis_client=self.redis)
         logger.info("RequestAnalyzer initialized successfully")
 
-    def analyze_requests(self):
-        keys = self.redis.get_all_keys()
+    def analyze_requests(self, keys=None):
+        """Analyze the given keys, or every proxy key when keys is None"""
         current_time = time.time()
         processed_count = 0
         ai_predictions = 0
+        post_urls = set()
 
-        for key in keys:
+        # Redis reads and writes run on their own threads so they overlap with model inference
+        stop = threading.Event()
+        read_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        reader = threading.Thread(target=self.read_batches, args=(read_queue, stop, current_time, keys), daemon=True)
+        writer = threading.Thread(target=self.write_batches, args=(write_queue,), daemon=True)
+        reader.start()
+        writer.start()
+
+        try:
+            for batch in iter(read_queue.get, None):
+                processed, predictions = self.analyze_batch(batch, current_time, post_urls, write_queue)
+                processed_count += processed
+                ai_predictions += predictions
+        finally:
+            stop.set()
+            # Unblock the reader if it is still waiting to hand over a chunk
+            while reader.is_alive():
+                try:
+                    read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            write_queue.put(None)
+            writer.join()
+
+        # Handle POSTs once the URL index covers every scanned key
+        for request_url in post_urls:
             try:
-                request_data = self.redis.get_request_data(key)
+                self.delete_old_requests(request_url)
+                self.mark_related_get_as_refresh(request_url)
+            except Exception as e:
+                logger.error(f"Error handling POST for URL {request_url}: {e}")
 
-                if not self.llama.check_inappropriate_content(request_data['request_url']):
-                    logger.warning(f"Request {key} contains inappropriate content and will be ignored.")
+        # Update analytics
+        self.analytics.record_batch(ai_predictions)
+        logger.info(f"Processed {processed_count} requests with {ai_predictions} AI predictions")
+
+    def read_batches(self, read_queue, stop, current_time, source_keys=None):
+        """Producer: fetch and index scan chunks, then hand them to the model loop"""
+        try:
+            source = self.redis.scan_keys() if source_keys is None else source_keys
+            for keys in chunked(source, SCAN_BATCH_SIZE):
+                if stop.is_set():
+                    return
+
+                # Fast path: skip keys analyzed recently (including the ones whose keyspace events
+                # came from our own writes) before fetching their full hashes and response bodies
+                keys = [
+                    key for key, request_data in zip(keys, self.redis.hmget_many(keys, ['last_analyzed']))
+                    if current_time - float(request_data['last_analyzed'] or 0) >= REANALYZE_AFTER
+                ]
+                if not keys:
                     continue
 
-                # AI-powered analysis
-                action = self.llama.analyze_request(request_data)
-                ai_predictions += 1
-
-                if action == 'delete':
-                    logger.info(f"Request {key} flagged for deletion.")
-                    self.redis.delete_request(key)
-                elif action == 'refresh':
-                    logger.info(f"Request {key} marked for refreshing.")
-                    self.redis.client.hset(key, "purpose", "refresh")
-                else:
-                    logger.info(f"Request {key} will be kept as is.")
-                    self.redis.client.hset(key, "purpose", "keep")
-
-                # TTL optimization
-                request_count = self.redis.get_request_count(key)
-                last_used_time = float(request_data.get('last_used', 0))
-                
-                if request_count == 1 and (current_time - last_used_time) > 72 * 3600:
-                    optimal_ttl = self.llama.predict_optimal_ttl(request_data)
-                    logger.info(f"Setting optimal TTL {optimal_ttl}s for {key}")
-                    self.redis.set_ttl(key, optimal_ttl)
-
-                if request_data["request_method"] == "POST":
-                    logger.info(f"POST request detected: {key}.")
-                    self.delete_old_requests(request_data["request_url"])
-                    self.mark_related_get_as_refresh(request_data["request_url"])
-
-                self.redis.increment_request_count(key)
-                processed_count += 1
-
-                # Update cache with the analyzed request data
-                self.llama.update_cache(request_data)
+                batch = list(zip(keys, self.redis.hgetall_many(keys)))
+                self.redis.index_requests(batch)
 
+                # Skip keys that expired or were removed since the batch was scanned, and hashes
+                # without a URL, which would otherwise fail the whole guard slice they land in
+                read_queue.put([(key, request_data) for key, request_data in batch if request_data.get('request_url')])
+        except Exception as e:
+            logger.error(f"Error reading requests from Redis: {e}")
+        finally:
+            read_queue.put(None)
+
+    def write_batches(self, write_queue):
+        """Consumer: flush each analyzed guard slice's updates and deletions"""
+        for updates, to_delete in iter(write_queue.get, None):
+            try:
+                pipe = self.redis.client.pipeline(transaction=False)
+                # Updates only touch keys that still exist, so a key that expired or was
+                # evicted while the models ran is not recreated as an empty hash
+                self.redis.update_requests(updates, pipe=pipe)
+                self.redis.delete_requests(to_delete, pipe=pipe)
+                pipe.execute()
             except Exception as e:
-                logger.error(f"Error analyzing request {key}: {e}")
+                logger.error(f"Error writing analysis results to Redis: {e}")
 
-        # Update analytics
-        self.analytics.update_ai_predictions(ai_predictions)
-        logger.info(f"Processed {processed_count} requests with {ai_predictions} AI predictions")
+    def analyze_batch(self, batch, current_time, post_urls, write_queue):
+        """Run the models over one scan chunk, handing Redis writes to the writer after each guard slice"""
+        processed_count = 0
+        ai_predictions = 0
+
+        for sub_batch in chunked(batch, GUARD_BATCH_SIZE):
+            updates = []
+            to_delete = []
+
+            for (key, request_data), allowed in zip(sub_batch, self.check_content(sub_batch)):
+                if allowed is None:
+                    # Guard check failed for this slice; already logged
+                    continue
+                if not allowed:
+                    logger.warning(f"Request {key} contains inappropriate content and will be ignored.")
+                    continue
+
+                try:
+                    # AI-powered analysis
+                    action = self.llama.analyze_request(request_data)
+                    ai_predictions += 1
+
+                    if action == 'delete':
+                        logger.info(f"Request {key} flagged for deletion.")
+                        to_delete.append((key, request_data))
+                        processed_count += 1
+                        continue
+                    elif action == 'refresh':
+                        logger.info(f"Request {key} marked for refreshing.")
+                    else:
+                        logger.info(f"Request {key} will be kept as is.")
+                    fields = {"purpose": action, "last_analyzed": current_time}
+
+                    # TTL optimization
+                    request_count = int(request_data.get('request_count') or 0)
+                    last_used_time = float(request_data.get('last_used', 0))
+
+                    ttl_set = request_data.get('ttl_set') == '1'
+                    optimal_ttl = None
+
+                    if not ttl_set and request_count == 1 and (current_time - last_used_time) > 72 * 3600:
+                        optimal_ttl = self.llama.predict_optimal_ttl(request_data)
+                        logger.info(f"Setting optimal TTL {optimal_ttl}s for {key}")
+                        fields["ttl_set"] = "1"
+
+                    if request_data["request_method"] == "POST":
+                        logger.info(f"POST request detected: {key}.")
+                        post_urls.add(request_data["request_url"])
+
+                    updates.append((key, fields, optimal_ttl, 1))
+                    processed_count += 1
+
+                except Exception as e:
+                    logger.error(f"Error analyzing request {key}: {e}")
+
+            write_queue.put((updates, to_delete))
+
+        return processed_count, ai_predictions
+
+    def check_content(self, sub_batch):
+        """Run the guard model over one slice of up to GUARD_BATCH_SIZE (key, request_data) pairs; None marks a failed check"""
+        try:
+            urls = [request_data['request_url'] for _, request_data in sub_batch]
+            return self.llama.check_inappropriate_content_batch(urls)
+        except Exception as e:
+            keys = [key for key, _ in sub_batch]
+            logger.error(f"Error checking content for requests {keys}: {e}")
+            return [None] * len(sub_batch)
 
     def delete_old_requests(self, request_url):
-        all_keys = self.redis.get_all_keys()
-        newest_time = None
-        newest_key = None
-
-        for key in all_keys:
-            request_data = self.redis.get_request_data(key)
-            if request_data["request_url"] == request_url:
-                request_time = float(request_data.get('last_used', 0))
-                if newest_time is None or request_time > newest_time:
-                    newest_time = request_time
-                    newest_key = key
-
-        if newest_key:
-            for key in all_keys:
-                request_data = self.redis.get_request_data(key)
-                if request_data["request_url"] == request_url:
-                    request_time = float(request_data.get('last_used', 0))
-                    if request_time < newest_time:
-                        logger.info(f"Deleting older request {key} for URL {request_data['request_url']}")
-                        self.redis.delete_request(key)
+        index_key = url_index_key(request_url)
+        entries = self.redis.client.zrange(index_key, 0, -1, withscores=True)
+        if not entries:
+            return
+
+        # Index entries may outlive the key or its URL, so read the live fields back
+        keys = [key for key, _ in entries]
+        live = []
+        stale = []
+        fields = ['request_url', 'request_method', 'last_used']
+        for key, request_data in zip(keys, self.redis.hmget_many(keys, fields)):
+            if same_url(request_data['request_url'], request_url):
+                live.append((key, request_data))
+            else:
+                stale.append(key)
+
+        old_requests = []
+        if live:
+            newest_time = max(float(request_data['last_used'] or 0) for _, request_data in live)
+            old_requests = [
+                (key, request_data) for key, request_data in live
+                if float(request_data['last_used'] or 0) < newest_time
+            ]
+        if not old_requests and not stale:
+            return
+
+        for key, _ in old_requests:
+            logger.info(f"Deleting older request {key} for URL {request_url}")
+
+        # delete_requests also drops the deleted keys from the index
+        pipe = self.redis.client.pipeline(transaction=False)
+        self.redis.delete_requests(old_requests, pipe=pipe)
+        if stale:
+            pipe.zrem(index_key, *stale)
+        pipe.execute()
 
     def mark_related_get_as_refresh(self, request_url):
-        all_keys = self.redis.get_all_keys()
-        for key in all_keys:
-            request_data = self.redis.get_request_data(key)
-            if request_data["request_method"] == "GET" and self.compare_urls(request_data["request_url"], request_url):
-                logger.info(f"Marking GET request {key} as 'refresh' for URL {request_data['request_url']}")
-                self.redis.client.hset(key, "purpose", "refresh")
+        index_key = method_index_key("GET", request_url)
+        keys = list(self.redis.client.smembers(index_key))
+        if not keys:
+            return
 
-    @staticmethod
-    def compare_urls(url1, url2):
-        return url1.lower() == url2.lower()  
+        # Index entries may outlive the key, its URL or its method, so verify before writing
+        pipe = self.redis.client.pipeline(transaction=False)
+        updates = []
+        for key, request_data in zip(keys, self.redis.hmget_many(keys, ['request_url', 'request_method'])):
+            if request_data['request_method'] == "GET" and same_url(request_data['request_url'], request_url):
+                logger.info(f"Marking GET request {key} as 'refresh' for URL {request_url}")
+                updates.append((key, {"purpose": "refresh"}, None, 0))
+            else:
+                pipe.srem(index_key, key)
+        self.redis.update_requests(updates, pipe=pipe)
+        pipe.execute()
 
     def run(self):
         logger.info("Starting request analyzer...")
+        try:
+            self.redis.enable_keyspace_events()
+        except Exception as e:
+            logger.warning(f"Could not enable keyspace notifications, relying on full sweeps: {e}")
+
+        pubsub = None
+        changed_keys = set()
+        last_sweep = 0
+        last_flush = time.time()
         while True:
             try:
-                self.analyze_requests()
-                time.sleep(600)  # Run every 10 minutes
+                if time.time() - last_sweep >= FULL_SWEEP_INTERVAL:
+                    changed_keys.clear()
+                    self.analyze_requests()
+                    last_sweep = last_flush = time.time()
+
+                if pubsub is None:
+                    # Subscribed inside the retried loop so a Redis blip at startup doesn't stop the analyzer
+                    subscriber = self.redis.client.pubsub(ignore_subscribe_messages=True)
+                    subscriber.psubscribe(f"__keyspace@{self.redis_db}__:proxy:*")
+                    pubsub = subscriber
+
+                message = pubsub.get_message(timeout=1.0)
+                if message:
+                    # Channel is "__keyspace@<db>__:<key>"
+                    changed_keys.add(message['channel'].split(':', 1)[1])
+
+                if changed_keys and (len(changed_keys) >= SCAN_BATCH_SIZE or time.time() - last_flush >= ANALYZE_DEBOUNCE):
+                    keys = list(changed_keys)
+                    changed_keys.clear()
+                    logger.info(f"Analyzing {len(keys)} changed requests")
+                    self.analyze_requests(keys)
+                    last_flush = time.time()
             except Exception as e:
                 logger.error(f"Error in analyzer loop: {e}")
                 time.sleep(60)  # Wait 1 minute before retrying
 
 class AnalyticsTracker:
-    def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0):
-        self.redis = RedisClient(host=redis_host, port=redis_port, db=redis_db)
+    def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0, redis_client=None):
+        self.redis = redis_client or RedisClient(host=redis_host, port=redis_port, db=redis_db)
 
-    def update_ai_predictions(self, count):
-        """Update AI predictions counter"""
-        self.redis.client.incr("stats:ai_predictions", count)
+    def record_batch(self, ai_predictions):
+        """Add a sweep's AI predictions to the stats counter; hits and misses are counted by go-proxy"""
+        if ai_predictions:
+            self.redis.client.incrby("stats:ai_predictions", int(ai_predictions))
 
     def get_performance_metrics(self):
         """Get comprehensive performance metrics"""
@@ -1,23 +1,155 @@
 import redis
 import json
+import hashlib
+import functools
+from itertools import islice
+
+def chunked(iterable, size):
+    # Dziel iterator na listy o rozmiarze co najwyżej size
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Pule połączeń współdzielone przez wszystkie instancje RedisClient
+_POOLS = {}
+
+def get_connection_pool(host, port, db):
+    # Zwróć (i w razie potrzeby utwórz) pulę połączeń dla danego (host, port, db)
+    key = (host, port, db)
+    if key not in _POOLS:
+        _POOLS[key] = redis.ConnectionPool(host=host, port=port, db=db, decode_responses=True, max_connections=64)
+    return _POOLS[key]
+
+@functools.lru_cache(maxsize=4096)
+def url_hash(url):
+    # Znormalizowany skrót URL używany w kluczach indeksu (zapamiętywany dla powtarzających się URL)
+    return hashlib.blake2b(url.lower().encode(), digest_size=16).hexdigest()
+
+def same_url(url1, url2):
+    # Porównaj URL tak samo jak indeks (bez rozróżniania wielkości liter)
+    return url1 is not None and url_hash(url1) == url_hash(url2)
+
+# Czas życia kluczy indeksu (s); odświeżany przy każdym indeksowaniu, więc martwe indeksy wygasają
+INDEX_TTL = 3600
+
+def url_index_key(url):
+    # Indeks ZSET: wszystkie klucze dla danego URL, score = last_used
+    return f"idx:url:{url_hash(url)}"
+
+def method_index_key(method, url):
+    # Indeks SET: klucze dla danej metody i URL
+    return f"idx:{method.lower()}:{url_hash(url)}"
+
+# Aktualizacja hasha tylko wtedy, gdy klucz nadal istnieje, żeby nie odtworzyć wygasłego lub usuniętego wpisu
+# ARGV: ttl ('' = bez zmiany), przyrost request_count, a dalej pary pole/wartość
+_UPDATE_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if #ARGV > 2 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+end
+if ARGV[1] ~= '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+if ARGV[2] ~= '0' then
+    redis.call('HINCRBY', KEYS[1], 'request_count', ARGV[2])
+end
+return 1
+"""
 
 # Klient Redis
 class RedisClient:
     def __init__(self, host='localhost', port=6379, db=0):
-        self.client = redis.StrictRedis(host=host, port=port, db=db, decode_responses=True)
+        self.client = redis.StrictRedis(connection_pool=get_connection_pool(host, port, db))
+        self._update_if_exists = self.client.register_script(_UPDATE_IF_EXISTS)
 
     def get_request_data(self, key):
         # Pobierz dane dla danego klucza
         data = self.client.hgetall(key)
         return data
 
+    def delete_requests(self, entries, pipe=None):
+        # Usuń klucze asynchronicznie (UNLINK) razem z wpisami w indeksach, w jednym round-tripie
+        # entries: pary (klucz, dane żądania) z polami request_url i request_method
+        # Jeśli podano pipe, polecenia są tylko dodawane do niego, a wykonanie należy do wywołującego
+        if not entries:
+            return
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.client.pipeline(transaction=False)
+        for key, request_data in entries:
+            pipe.unlink(key)
+            url = request_data.get("request_url")
+            method = request_data.get("request_method")
+            if url:
+                pipe.zrem(url_index_key(url), key)
+                if method:
+                    pipe.srem(method_index_key(method, url), key)
+        if own_pipe:
+            pipe.execute()
+
+    def update_requests(self, updates, pipe=None):
+        # Zaktualizuj istniejące klucze w jednym round-tripie; brakujące klucze są pomijane
+        # updates: krotki (klucz, pola, ttl lub None, przyrost request_count)
+        if not updates:
+            return
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.client.pipeline(transaction=False)
+        for key, fields, ttl, increment in updates:
+            args = ['' if ttl is None else int(ttl), int(increment)]
+            for field, value in fields.items():
+                args.extend([field, value])
+            self._update_if_exists(keys=[key], args=args, client=pipe)
+        if own_pipe:
+            pipe.execute()
+
     def set_ttl(self, key, ttl_seconds):
         # Ustaw TTL dla klucza
         self.client.expire(key, ttl_seconds)
 
-    def get_all_keys(self, pattern='proxy:*'):
-        # Pobierz wszystkie klucze pasujące do wzorca
-        return self.client.keys(pattern)
+    def scan_keys(self, pattern='proxy:*', count=500):
+        # Iteruj po kluczach pasujących do wzorca (SCAN zamiast blokującego KEYS)
+        return self.client.scan_iter(match=pattern, count=count)
+
+    def hgetall_many(self, keys):
+        # Pobierz dane wielu kluczy w jednym round-tripie
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return pipe.execute()
+
+    def hmget_many(self, keys, fields):
+        # Pobierz wybrane pola wielu kluczy w jednym round-tripie
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, fields)
+        return [dict(zip(fields, values)) for values in pipe.execute()]
+
+    def index_requests(self, entries):
+        # Zaktualizuj indeksy URL dla par (klucz, dane żądania) w jednym round-tripie
+        pipe = self.client.pipeline(transaction=False)
+        for key, request_data in entries:
+            url = request_data.get("request_url")
+            method = request_data.get("request_method")
+            if not url or not method:
+                continue
+            pipe.zadd(url_index_key(url), {key: float(request_data.get("last_used", 0))})
+            pipe.expire(url_index_key(url), INDEX_TTL)
+            pipe.sadd(method_index_key(method, url), key)
+            pipe.expire(method_index_key(method, url), INDEX_TTL)
+        pipe.execute()
+
+    def enable_keyspace_events(self, flags='Kh'):
+        # Włącz powiadomienia keyspace dla poleceń na hashach, zachowując już ustawione flagi
+        current = self.client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        missing = ''.join(flag for flag in flags if flag not in current)
+        if missing:
+            self.client.config_set('notify-keyspace-events', current + missing)
 
     def get_request_count(self, key):
         # Pobierz liczbę żądań zliczając wystąpienia